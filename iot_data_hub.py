@@ -11,10 +11,18 @@ with an MQTT broker to publish and subscribe to topics.
 import sys
 import time
 import _thread
-import random
+import os
+
+# Lookup table mapping every byte value onto the client ID alphabet
+_ID_CHARS = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+_ID_TABLE = bytes(_ID_CHARS[i % len(_ID_CHARS)] for i in range(256))
 
 # Main class for the IoT Data Hub
 class IoTDataHub:
+
+    # Maximum number of encoded topics kept by _full_topic
+    TOPIC_CACHE_SIZE = 64
+
     def __init__(self,
                 ssid,
                 password,
@@ -29,32 +37,38 @@ class IoTDataHub:
         self.password = password
         self.callback = callback_func
         self.abort = False
+        # Held while the message loop thread is running
+        self._stopped = None
+        self._loop_id = None
         self.verbose = verbose
+        # Verbose messages go through _log, a no-op when not verbose
+        self._log = print if verbose else (lambda *a, **k: None)
 
         # MQTT Credentials
         if mqtt_client_id is None:
             self.mqtt_client_id = self.__get_random_device_id(20)
         else:
             self.mqtt_client_id = mqtt_client_id
-        if self.verbose:
-            print(f"++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\nClient ID: {self.mqtt_client_id}")
+        self._log("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++\nClient ID:", self.mqtt_client_id)
         self.mqtt_account_id = mqtt_account_id
+        # "<account_id>/" prefix of every topic, as sent to the broker
+        self._pub_prefix = (str(mqtt_account_id) + "/").encode()
+        self._prefix_len = len(self._pub_prefix)
+        self._topic_bytes = {}
         self.mqtt_server = "broker.mqttdashboard.com"
         self.mqtt_port = 1883
         self.mqtt_user = ""
         self.mqtt_password = ""
 
         # Connect to Wi-Fi
-        if self.verbose:
-            print(f"Connecting to Wi-Fi {self.ssid}")
+        self._log("Connecting to Wi-Fi", self.ssid)
         self.station = self.__wifi_connect()
         if not self.station.isconnected():
             print(f"Failed to connect to network {self.ssid}!")
             sys.exit(1)
 
         # Connect to MQTT Broker
-        if self.verbose:
-            print(f"Connecting to MQTT Broker {self.mqtt_server}")
+        self._log("Connecting to MQTT Broker", self.mqtt_server)
         self.mqtt_client = MQTTClient(self.mqtt_client_id,
                                       self.mqtt_server,
                                       self.mqtt_port,
@@ -63,20 +77,28 @@ class IoTDataHub:
         self.mqtt_client.connect()
         if self.callback is not None:
             self.mqtt_client.set_callback(self.message_received)
+            self._stopped = _thread.allocate_lock()
+            self._stopped.acquire()
             _thread.start_new_thread(self.check_message_loop, ())
 
-    # Loop to check for MQTT messages
+    # Loop to check for MQTT messages. Between packets it only waits in
+    # msg_pending; check_msg then takes the client lock, so it does not
+    # race publish/subscribe for their acks, and blocks only while a
+    # packet arrives partially.
     def check_message_loop(self):
-        while True:
-            self.mqtt_client.check_msg()
-            if self.abort:
-                break
-            time.sleep(.5)
+        self._loop_id = _thread.get_ident()
+        stopped = self._stopped
+        client = self.mqtt_client
+        try:
+            while not self.abort:
+                if client.msg_pending(500):
+                    client.check_msg()
+        finally:
+            stopped.release()
 
     # Method called when a message is received
     def message_received(self, topic, msg):
-        topic_list = topic.decode().split('/')
-        self.callback('/'.join(topic_list[1:]), msg.decode())
+        self.callback(topic[self._prefix_len:].decode(), msg.decode())
 
     # Method to disconnect from MQTT and Wi-Fi
     def __del__(self):
@@ -84,7 +106,15 @@ class IoTDataHub:
 
     def disconnect(self):
         self.abort = True
-        time.sleep(1)
+        if self._stopped is not None and _thread.get_ident() != self._loop_id:
+            # Wait up to 1 s for the message loop to exit. It may be stuck
+            # in wait_msg on a partial packet; the socket is closed anyway.
+            # MicroPython locks ignore the acquire timeout, so poll instead.
+            for _ in range(20):
+                if self._stopped.acquire(0):
+                    break
+                time.sleep(.05)
+        self._stopped = None
         if self.mqtt_client is not None:
             self.mqtt_client.disconnect()
             self.mqtt_client = None
@@ -94,18 +124,34 @@ class IoTDataHub:
 
     # Publish an MQTT message
     def publish(self, topic, value):
-        if self.verbose:
-            print(f"Publishing value '{value}' in the topic '{topic}'")
-        self.mqtt_client.publish(f"{self.mqtt_account_id}/{topic}", value)
+        self._log("Publishing value", value, "in the topic", topic)
+        self.mqtt_client.publish(self._full_topic(topic), value)
 
     # Subscribe to an MQTT topic
     def subscribe(self, topic):
-        if self.verbose:
-            print(f"Subscribing '{topic}'")
+        self._log("Subscribing", topic)
         if self.callback is None:
             print("ERROR: Subscribe not allowed. The 4th parameter (callback_func) was not provided to the IoTDataHub constructor.")
             sys.exit(1)
-        self.mqtt_client.subscribe(f"{self.mqtt_account_id}/{topic}")
+        self.mqtt_client.subscribe(self._full_topic(topic))
+
+    # Prepend the account prefix to a topic, caching the result.
+    # Topics other than str and bytes are converted with str(), as
+    # before, and cached under that string: 1, 1.0 and True compare
+    # equal as keys but give different topics.
+    def _full_topic(self, topic):
+        if not isinstance(topic, (str, bytes)):
+            topic = str(topic)
+        encoded = self._topic_bytes.get(topic)
+        if encoded is None:
+            if len(self._topic_bytes) >= self.TOPIC_CACHE_SIZE:
+                del self._topic_bytes[next(iter(self._topic_bytes))]
+            if isinstance(topic, str):
+                encoded = self._pub_prefix + topic.encode()
+            else:
+                encoded = self._pub_prefix + topic
+            self._topic_bytes[topic] = encoded
+        return encoded
 
     # Connect to Wi-Fi
     def __wifi_connect(self):
@@ -115,32 +161,82 @@ class IoTDataHub:
         station.active(True)
         station.disconnect()
         station.connect(self.ssid, self.password)
-        for t in range(50):
-            if station.isconnected():
-                break
-            time.sleep(0.1)
+        # Poll with backoff from 10 ms up to 200 ms, giving up after 5 seconds
+        delay = 0.01
+        waited = 0
+        while waited < 5 and not station.isconnected():
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, 0.2)
         return station
 
     def __get_random_device_id(self, n):
-        caracteres = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-        resultado = ''
-        for _ in range(n):
-            resultado += caracteres[random.randint(0, len(caracteres)-1)]
-        return resultado
+        resultado = bytearray(os.urandom(n))
+        for i in range(n):
+            resultado[i] = _ID_TABLE[resultado[i]]
+        return resultado.decode()
 
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 try:
     import usocket as socket
 except:
     import socket
+try:
+    import uselect as select
+except:
+    import select
 import ustruct as struct
 from ubinascii import hexlify
 
 class MQTTException(Exception):
     pass
 
+# MQTT packet types and fixed packets
+_CONNECT = 0x10
+_CONNACK = 0x20
+_PUBLISH = 0x30
+_PUBACK = 0x40
+_SUBSCRIBE = 0x82
+_SUBACK = 0x90
+_PINGRESP = 0xd0
+_PROTOCOL = b"\0\x04MQTT\x04"
+_PING = b"\xc0\0"
+_DISCONNECT = b"\xe0\0"
+
+# Returns s as bytes, UTF-8 encoding it if it is a str.
+def _to_bytes(s):
+    if isinstance(s, str):
+        return s.encode()
+    return s
+
+# Writes the MQTT remaining length sz into buf at offset off.
+# Returns the number of bytes used (1 to 4).
+def _encode_varint(sz, buf, off):
+    if sz < 0x80:
+        buf[off] = sz
+        return 1
+    if sz < 0x4000:
+        buf[off] = (sz & 0x7f) | 0x80
+        buf[off + 1] = sz >> 7
+        return 2
+    if sz < 0x200000:
+        buf[off] = (sz & 0x7f) | 0x80
+        buf[off + 1] = (sz >> 7 & 0x7f) | 0x80
+        buf[off + 2] = sz >> 14
+        return 3
+    buf[off] = (sz & 0x7f) | 0x80
+    buf[off + 1] = (sz >> 7 & 0x7f) | 0x80
+    buf[off + 2] = (sz >> 14 & 0x7f) | 0x80
+    buf[off + 3] = sz >> 21
+    return 4
+
 class MQTTClient:
 
+    # Resolved broker addresses shared by all clients:
+    # (server, port) -> (sockaddr, expiry time)
+    _addr_cache = {}
+    ADDR_TTL = 300
+
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
                  ssl=False, ssl_params={}):
         if port == 0:
@@ -160,21 +256,96 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
-
-    def _send_str(self, s):
-        self.sock.write(struct.pack("!H", len(s)))
-        self.sock.write(s)
+        # Serializes socket and buffer use between threads. The owning
+        # thread may take it again, e.g. publishing from the callback.
+        self._lock = _thread.allocate_lock()
+        self._owner = None
+        # Receive buffer; unread data lives in _rx[_head:_tail]
+        self._rx = bytearray(4096)
+        self._rxmv = memoryview(self._rx)
+        self._head = 0
+        self._tail = 0
+        # Send buffer; whole packets are assembled here and written at once
+        self._tx = bytearray(256)
+        # Scratch buffer for small fixed-size control packets
+        self._hdr = bytearray(8)
+
+    # Takes the client lock unless this thread already holds it.
+    # Returns True if it was taken and must be released.
+    def _acquire(self):
+        me = _thread.get_ident()
+        if self._owner == me:
+            return False
+        self._lock.acquire()
+        self._owner = me
+        return True
+
+    def _release(self):
+        self._owner = None
+        self._lock.release()
+
+    # Returns the send buffer, grown to hold at least n bytes.
+    def _tx_buf(self, n):
+        if n > len(self._tx):
+            self._tx = bytearray(n)
+        return self._tx
+
+    # Stores the bytes s into buf at offset i prefixed by its length
+    # and returns the offset right after it.
+    def _put_str(self, buf, i, s):
+        n = len(s)
+        struct.pack_into("!H", buf, i, n)
+        i += 2
+        buf[i:i + n] = s
+        return i + n
+
+    # Make sure at least n unread bytes are in the receive buffer.
+    # Only the missing bytes are requested: MicroPython's blocking
+    # readinto does not return until the whole request is filled.
+    def _ensure(self, n):
+        if self._tail - self._head >= n:
+            return
+        if self._head == self._tail:
+            self._head = self._tail = 0
+        if self._head + n > len(self._rx):
+            # Move unread data to the front, growing the buffer if needed
+            data = bytes(self._rxmv[self._head:self._tail])
+            if n > len(self._rx):
+                self._rx = bytearray(n)
+                self._rxmv = memoryview(self._rx)
+            self._rx[:len(data)] = data
+            self._head = 0
+            self._tail = len(data)
+        while self._tail - self._head < n:
+            r = self.sock.readinto(self._rxmv[self._tail:],
+                                   n - (self._tail - self._head))
+            if not r:
+                raise OSError(-1)
+            self._tail += r
 
     def _recv_len(self):
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            self._ensure(1)
+            b = self._rx[self._head]
+            self._head += 1
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
             sh += 7
 
+    # Returns the broker address and whether it came from the cache.
+    def _resolve(self):
+        key = (self.server, self.port)
+        entry = MQTTClient._addr_cache.get(key)
+        now = time.time()
+        if entry is not None and entry[1] > now:
+            return entry[0], True
+        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
+        MQTTClient._addr_cache[key] = (addr, now + self.ADDR_TTL)
+        return addr, False
+
     def set_callback(self, f):
         self.cb = f
 
@@ -187,111 +358,153 @@ class MQTTClient:
         self.lw_retain = retain
 
     def connect(self, clean_session=True):
+        self._head = self._tail = 0
         self.sock = socket.socket()
-        addr = socket.getaddrinfo(self.server, self.port)[0][-1]
-        self.sock.connect(addr)
+        addr, cached = self._resolve()
+        try:
+            self.sock.connect(addr)
+        except OSError:
+            if not cached:
+                raise
+            # The cached address may be stale, resolve it again
+            self.sock.close()
+            del MQTTClient._addr_cache[(self.server, self.port)]
+            self.sock = socket.socket()
+            self.sock.connect(self._resolve()[0])
         if self.ssl:
             import ussl
             self.sock = ussl.wrap_socket(self.sock, **self.ssl_params)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\x04MQTT\x04\x02\0\0")
+        self._poll = select.poll()
+        self._poll.register(self.sock, select.POLLIN)
 
-        sz = 10 + 2 + len(self.client_id)
-        msg[6] = clean_session << 1
+        # Encode the strings first so the lengths match the bytes sent
+        client_id = _to_bytes(self.client_id)
+        sz = 10 + 2 + len(client_id)
+        flags = clean_session << 1
         if self.user is not None:
-            sz += 2 + len(self.user) + 2 + len(self.pswd)
-            msg[6] |= 0xC0
+            user = _to_bytes(self.user)
+            pswd = _to_bytes(self.pswd)
+            sz += 2 + len(user) + 2 + len(pswd)
+            flags |= 0xC0
         if self.keepalive:
             assert self.keepalive < 65536
-            msg[7] |= self.keepalive >> 8
-            msg[8] |= self.keepalive & 0x00FF
         if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[6] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[6] |= self.lw_retain << 5
-
-        i = 1
-        while sz > 0x7f:
-            premsg[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        premsg[i] = sz
-
-        self.sock.write(premsg, i + 2)
-        self.sock.write(msg)
-        #print(hex(len(msg)), hexlify(msg, ":"))
-        self._send_str(self.client_id)
+            lw_topic = _to_bytes(self.lw_topic)
+            lw_msg = _to_bytes(self.lw_msg)
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg)
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+
+        pkt = self._tx_buf(sz + 5)
+        pkt[0] = _CONNECT
+        i = 1 + _encode_varint(sz, pkt, 1)
+
+        pkt[i:i + 7] = _PROTOCOL
+        pkt[i + 7] = flags
+        pkt[i + 8] = self.keepalive >> 8
+        pkt[i + 9] = self.keepalive & 0x00FF
+        i += 10
+        i = self._put_str(pkt, i, client_id)
         if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
+            i = self._put_str(pkt, i, lw_topic)
+            i = self._put_str(pkt, i, lw_msg)
         if self.user is not None:
-            self._send_str(self.user)
-            self._send_str(self.pswd)
-        resp = self.sock.read(4)
-        assert resp[0] == 0x20 and resp[1] == 0x02
-        if resp[3] != 0:
-            raise MQTTException(resp[3])
-        return resp[2] & 1
+            i = self._put_str(pkt, i, user)
+            i = self._put_str(pkt, i, pswd)
+        #print(hex(i), hexlify(pkt[:i], ":"))
+        self.sock.write(pkt, i)
+        self._ensure(4)
+        resp = self._rx
+        i = self._head
+        self._head += 4
+        assert resp[i] == _CONNACK and resp[i + 1] == 0x02
+        if resp[i + 3] != 0:
+            raise MQTTException(resp[i + 3])
+        return resp[i + 2] & 1
 
     def disconnect(self):
-        self.sock.write(b"\xe0\0")
+        self.sock.write(_DISCONNECT)
         self.sock.close()
 
     def ping(self):
-        self.sock.write(b"\xc0\0")
+        self.sock.write(_PING)
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        locked = self._acquire()
+        try:
+            return self._publish(topic, msg, retain, qos)
+        finally:
+            if locked:
+                self._release()
+
+    def _publish(self, topic, msg, retain, qos):
+        topic = _to_bytes(topic)
+        msg = _to_bytes(msg)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
-        i = 1
-        while sz > 0x7f:
-            pkt[i] = (sz & 0x7f) | 0x80
-            sz >>= 7
-            i += 1
-        pkt[i] = sz
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
+        pkt = self._tx_buf(sz + 4)
+        pkt[0] = _PUBLISH | qos << 1 | retain
+        i = 1 + _encode_varint(sz, pkt, 1)
+        i = self._put_str(pkt, i, topic)
         if qos > 0:
             self.pid += 1
             pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+            struct.pack_into("!H", pkt, i, pid)
+            i += 2
+        pkt[i:i + len(msg)] = msg
+        i += len(msg)
+        #print(hex(i), hexlify(pkt[:i], ":"))
+        self.sock.write(pkt, i)
         if qos == 1:
             while 1:
                 op = self.wait_msg()
-                if op == 0x40:
-                    sz = self.sock.read(1)
-                    assert sz == b"\x02"
-                    rcv_pid = self.sock.read(2)
-                    rcv_pid = rcv_pid[0] << 8 | rcv_pid[1]
+                if op == _PUBACK:
+                    self._ensure(3)
+                    resp = self._rx
+                    i = self._head
+                    self._head += 3
+                    assert resp[i] == 0x02
+                    rcv_pid = resp[i + 1] << 8 | resp[i + 2]
                     if pid == rcv_pid:
                         return
         elif qos == 2:
             assert 0
 
     def subscribe(self, topic, qos=0):
+        locked = self._acquire()
+        try:
+            return self._subscribe(topic, qos)
+        finally:
+            if locked:
+                self._release()
+
+    def _subscribe(self, topic, qos):
         assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0")
+        topic = _to_bytes(topic)
+        sz = 2 + 2 + len(topic) + 1
+        pkt = self._tx_buf(sz + 4)
+        pkt[0] = _SUBSCRIBE
+        i = 1 + _encode_varint(sz, pkt, 1)
         self.pid += 1
-        struct.pack_into("!BH", pkt, 1, 2 + 2 + len(topic) + 1, self.pid)
-        #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt)
-        self._send_str(topic)
-        self.sock.write(qos.to_bytes(1, "little"))
+        pid = self.pid
+        struct.pack_into("!H", pkt, i, pid)
+        i = self._put_str(pkt, i + 2, topic)
+        pkt[i] = qos
+        i += 1
+        #print(hex(i), hexlify(pkt[:i], ":"))
+        self.sock.write(pkt, i)
         while 1:
             op = self.wait_msg()
-            if op == 0x90:
-                resp = self.sock.read(4)
-                #print(resp)
-                assert resp[1] == pkt[2] and resp[2] == pkt[3]
-                if resp[3] == 0x80:
-                    raise MQTTException(resp[3])
+            if op == _SUBACK:
+                self._ensure(4)
+                resp = self._rx
+                i = self._head
+                self._head += 4
+                assert resp[i + 1] << 8 | resp[i + 2] == pid
+                if resp[i + 3] == 0x80:
+                    raise MQTTException(resp[i + 3])
                 return
 
     # Wait for a single incoming MQTT message and process it.
@@ -299,43 +512,60 @@ class MQTTClient:
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
-        res = self.sock.read(1)
-        self.sock.setblocking(True)
-        if res is None:
-            return None
-        if res == b"":
-            raise OSError(-1)
-        if res == b"\xd0":  # PINGRESP
-            sz = self.sock.read(1)[0]
+        self._ensure(1)
+        op = self._rx[self._head]
+        self._head += 1
+        if op == _PINGRESP:
+            self._ensure(1)
+            sz = self._rx[self._head]
+            self._head += 1
             assert sz == 0
             return None
-        op = res[0]
-        if op & 0xf0 != 0x30:
+        if op & 0xf0 != _PUBLISH:
             return op
         sz = self._recv_len()
-        topic_len = self.sock.read(2)
-        topic_len = (topic_len[0] << 8) | topic_len[1]
-        topic = self.sock.read(topic_len)
-        sz -= topic_len + 2
+        self._ensure(sz)
+        rx = self._rx
+        i = self._head
+        end = i + sz
+        self._head = end
+        topic_len = (rx[i] << 8) | rx[i + 1]
+        i += 2
+        topic = bytes(self._rxmv[i:i + topic_len])
+        i += topic_len
         if op & 6:
-            pid = self.sock.read(2)
-            pid = pid[0] << 8 | pid[1]
-            sz -= 2
-        msg = self.sock.read(sz)
+            pid = rx[i] << 8 | rx[i + 1]
+            i += 2
+        msg = bytes(self._rxmv[i:end])
         self.cb(topic, msg)
         if op & 6 == 2:
-            pkt = bytearray(b"\x40\x02\0\0")
+            pkt = self._hdr
+            pkt[0] = _PUBACK
+            pkt[1] = 0x02
             struct.pack_into("!H", pkt, 2, pid)
-            self.sock.write(pkt)
+            self.sock.write(pkt, 4)
         elif op & 6 == 4:
             assert 0
 
+    # Waits up to timeout milliseconds for data from the server.
+    # Returns True if some data is buffered or readable. This may be
+    # only part of a packet, in which case wait_msg blocks until the
+    # rest of it arrives.
+    def msg_pending(self, timeout=0):
+        return self._tail > self._head or bool(self._poll.poll(timeout))
+
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # the same processing as wait_msg. Holds the client lock, so it
+    # is safe to call while another thread publishes or subscribes.
     def check_msg(self):
-        self.sock.setblocking(False)
-        return self.wait_msg()
+        locked = self._acquire()
+        try:
+            if self.msg_pending():
+                return self.wait_msg()
+        finally:
+            if locked:
+                self._release()
 
     def sleep(self, t):
         while True: